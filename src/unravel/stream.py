@@ -7,12 +7,135 @@ Created on Wed Aug 16 11:25:30 2023
 
 
 import numpy as np
-from sklearn.cluster import KMeans
 from dipy.io.stateful_tractogram import Space, StatefulTractogram, Origin
 from dipy.io.streamline import load_tractogram, save_tractogram
 from unravel.utils import tract_to_ROI, xyz_to_spherical
 from skimage.morphology import flood
-from sklearn.neighbors import KernelDensity
+from scipy.spatial.distance import cdist
+
+
+def _orient_endpoints(streams_data, offsets, lengths):
+    '''
+    Orients the streamlines so that their first points are on the same side
+    of the bundle. Streamlines are split by the sign of their end-to-end
+    direction along the axis where these directions vary the most.
+
+    Parameters
+    ----------
+    streams_data : 2D array of size (n, 3)
+        Coordinates (x,y,z) of the n tractography points.
+    offsets : 1D array of size (s,)
+        Index of the first point of each of the s streamlines.
+    lengths : 1D array of size (s,)
+        Number of points of each of the s streamlines.
+
+    Returns
+    -------
+    start : 2D array of size (s, 3)
+        Coordinates (x,y,z) of the oriented first point of each streamline.
+    end : 2D array of size (s, 3)
+        Coordinates (x,y,z) of the oriented last point of each streamline.
+    selec_streamlines : 1D array of size (s,)
+        True for the long streamlines [Q3:Q3+1.5*IQR] used to compute the mean
+        end points.
+
+    '''
+
+    end_0 = streams_data[offsets, :]
+    end_1 = streams_data[offsets+lengths-1, :]
+    dirs = end_1-end_0
+
+    # Flipping streamlines pointing in the negative direction of the main axis
+    axis = np.var(dirs, axis=0).argmax()
+    flip = dirs[:, axis] < 0
+    start = np.where(flip[:, np.newaxis], end_1, end_0)
+    end = np.where(flip[:, np.newaxis], end_0, end_1)
+
+    # Only compute the mean end points of long fibers [Q3:Q3+1.5*IQR]
+    q1, q3 = np.percentile(lengths, [25, 75])
+    selec_streamlines = (lengths > q3) & (lengths <= q3+1.5*(q3-q1))
+
+    return start, end, selec_streamlines
+
+
+def _get_crossing_indexes(side, offsets_mask):
+    '''
+    Returns the indexes of the points that are not on the same side of a
+    surface as the previous point of their streamline.
+
+    Parameters
+    ----------
+    side : 1D array of size (n,)
+        Boolean array, True for the points on the positive side of the surface.
+    offsets_mask : 1D array of size (n,)
+        Boolean array, True at the first point of each streamline.
+
+    Returns
+    -------
+    idx : 2D array of size (k, 1)
+        Indexes of the k points crossing the surface.
+
+    '''
+
+    crossing = np.zeros(len(side), dtype=bool)
+    np.not_equal(side[1:], side[:-1], out=crossing[1:])
+    crossing &= ~offsets_mask
+
+    return np.argwhere(crossing)
+
+
+def _get_node_position(streams_data, offsets_mask, m_start, m_end,
+                       normal_previous, normal_next):
+    '''
+    Computes the mean position of the streamline points crossing the surface
+    perpendicular to [m_start, m_end] at its midpoint. Only the points located
+    between the previous and next surfaces are considered.
+
+    Parameters
+    ----------
+    streams_data : 2D array of size (n, 3)
+        Coordinates (x,y,z) of the n tractography points.
+    offsets_mask : 1D array of size (n,)
+        Boolean array, True at the first point of each streamline.
+    m_start : 1D array of size 3
+        Coordinates (x,y,z) of the previous mean trajectory point.
+    m_end : 1D array of size 3
+        Coordinates (x,y,z) of the next mean trajectory point.
+    normal_previous : 1D array of size 3
+        Normal of the surface at m_start.
+    normal_next : 1D array of size 3
+        Normal of the surface at m_end.
+
+    Returns
+    -------
+    node : 1D array of size 3
+        Coordinates (x,y,z) of the mean trajectory point. Returns the midpoint
+        if no streamline crosses the surface.
+
+    '''
+
+    midpoint = (m_start+m_end)/2
+    normal = m_start-m_end
+
+    # Find indexes that cross the surface
+    idx = _get_crossing_indexes(streams_data@normal > midpoint@normal,
+                                offsets_mask)
+    points = streams_data[idx[:, 0], :]
+
+    # Creating filter based on previous and next surface, only evaluated on
+    # the crossing points
+    mp_sign_previous = (midpoint-m_start)@normal_previous > 0
+    mp_sign_next = (midpoint-m_end)@normal_next > 0
+    sign_previous = points@normal_previous > m_start@normal_previous
+    sign_next = points@normal_next > m_end@normal_next
+    points = points[(sign_previous == mp_sign_previous)
+                    & (sign_next == mp_sign_next)]
+
+    # Computing mean position on the surface
+    if len(points) == 0:
+        return midpoint
+
+    return np.mean(points, axis=0)
 
 
 def extract_nodes(trk_file: str, level: int = 3, smooth: bool = True):
@@ -39,25 +162,15 @@ def extract_nodes(trk_file: str, level: int = 3, smooth: bool = True):
     trk.to_corner()
 
     streams = trk.streamlines
-    streams_data = trk.streamlines.get_data()
+    streams_data = np.ascontiguousarray(streams.get_data(), dtype=np.float32)
+    offsets = streams._offsets
+    lengths = streams._lengths
 
-    # Clustering end nodes based on streamline directions
-    end_0 = streams_data[streams._offsets, :]
-    end_1 = np.roll(streams_data[streams._offsets-1, :], -1, axis=0)
-    dirs = end_1-end_0
-    kmeans = KMeans(n_clusters=2, n_init="auto").fit(dirs)
+    offsets_mask = np.zeros(len(streams_data), dtype=bool)
+    offsets_mask[offsets] = True
 
-    # Assigning start and end based on clustering
-    start = end_0.copy()
-    end = end_1.copy()
-    start[kmeans.labels_ == 1, :] = end_1[kmeans.labels_ == 1, :]
-    end[kmeans.labels_ == 1, :] = end_0[kmeans.labels_ == 1, :]
-
-    # Only compute the mean end points of long fibers [Q3:Q3+1.5*IQR]
-    q1, q3 = np.percentile(streams._lengths, [25, 75])
-    long_streamlines = streams._lengths > q3
-    outlier_streamlines = streams._lengths > q3+1.5*(q3-q1)
-    selec_streamlines = long_streamlines*~outlier_streamlines
+    start, end, selec_streamlines = _orient_endpoints(streams_data, offsets,
+                                                      lengths)
     m_start = np.mean(start[selec_streamlines], axis=0)
     m_end = np.mean(end[selec_streamlines], axis=0)
 
@@ -82,10 +195,10 @@ def extract_nodes(trk_file: str, level: int = 3, smooth: bool = True):
 
     # point_array = np.vstack((m_start, m_end))
 
-    point_array = np.zeros((2**level+1, 3))
+    point_array = np.zeros((2**level+1, 3), dtype=np.float32)
     point_array[0] = m_start
     point_array[-1] = m_end
-    normal_array = np.zeros(point_array.shape)
+    normal_array = np.zeros(point_array.shape, dtype=np.float32)
     normal_array[0] = m_start-m_end
     normal_array[-1] = m_start-m_end
 
@@ -96,49 +209,18 @@ def extract_nodes(trk_file: str, level: int = 3, smooth: bool = True):
             m_end = point_array[2**(level-j-1)*(2*i+2)]
 
             # Computing normal of perpendicular surface at midpoint
-            midpoint = (m_start+m_end)/2
             normal = m_start-m_end
             normal_array[2**(level-j-1)*(2*i+1)] = normal
 
-            # Computing normal at start
-            normal_previous = normal_array[2**(level-j-1)*(2*i)]
-            ns_previous = streams_data-m_start
-            sign_previous = np.where(np.sum(ns_previous*normal_previous,
-                                            axis=1) > 0, 1, -1)
-
-            # Computing normal at end
-            normal_next = normal_array[2**(level-j-1)*(2*i+2)]
-            ns_next = streams_data-m_end
-            sign_next = np.where(np.sum(ns_next*normal_next, axis=1) > 0, 1, -1)
-
-            # Creating filter based on previous and next surface
-            mp_previous = midpoint-m_start
-            mp_next = midpoint-m_end
-            mp_sign_previous = np.where(np.sum(mp_previous*normal_previous) > 0,
-                                        1, -1)
-            mp_sign_next = np.where(np.sum(mp_next*normal_next) > 0, 1, -1)
-            sign_previous = np.where(sign_previous == mp_sign_previous, 1, 0)
-            sign_next = np.where(sign_next == mp_sign_next, 1, 0)
-            idx_filter = np.argwhere(sign_next+sign_previous != 2)
-
-            # Find indexes that cross the surface
-            ns = streams_data-midpoint
-            sign = np.where(np.sum(ns*normal, axis=1) > 0, 1, 0)
-            idx = np.argwhere(abs(np.roll(sign, 1)-sign) == 1)
-            idx = np.array(
-                list(filter(lambda x: x not in streams._offsets, idx)))
-            idx = np.array(list(filter(lambda x: x not in idx_filter, idx)))
-
-            # Computing mean position on the surface
-            try:
-                points = streams_data[idx, :]
-                point_array[2**(level-j-1)*(2*i+1)] = np.mean(points, axis=0)
-            except IndexError:
-                point_array[2**(level-j-1)*(2*i+1)] = midpoint
+            point_array[2**(level-j-1)*(2*i+1)] = _get_node_position(
+                streams_data, offsets_mask, m_start, m_end,
+                normal_array[2**(level-j-1)*(2*i)],
+                normal_array[2**(level-j-1)*(2*i+2)])
 
     if smooth:
-        _, point_array = get_dist_from_median_trajectory(trk_file, point_array,
-                                                         compute_dist=False)
+        _, point_array = _get_dist_from_median_trajectory(
+            streams, streams_data, tract_to_ROI(trk), point_array,
+            compute_dist=False)
 
     return point_array
 
@@ -151,7 +233,8 @@ def get_streamline_number_from_index(streams, index: int) -> int:
     streams : streamlines.array_sequence.ArraySequence
         DESCRIPTION.
     index : int or array (n,1)
-        Number of the tractography point (x,y,z).
+        Number of the tractography point (x,y,z). Arrays of any shape are
+        flattened.
 
     Returns
     -------
@@ -160,12 +243,10 @@ def get_streamline_number_from_index(streams, index: int) -> int:
 
     '''
 
-    offsets = np.append(streams._offsets, len(streams._data))
-    isin = np.where(offsets-index > 0, 1, 0)
-    if type(index) == int:
-        nb = np.argwhere(np.roll(isin, -1)-isin == 1)[0][0]
-    else:
-        nb = np.argwhere(np.roll(isin, -1, axis=1)-isin == 1)[:, 1]
+    index = np.asarray(index)
+    nb = np.searchsorted(streams._offsets, index.ravel(), side='right')-1
+    if index.ndim == 0:
+        nb = int(nb[0])
 
     return nb
 
@@ -178,19 +259,58 @@ def remove_streamlines(streams, idx: int):
     ----------
     streams : streamlines.array_sequence.ArraySequence
         DESCRIPTION.
-    idx : int
-        Streamline number.
+    idx : int or array
+        Streamline number(s).
 
-    Yields
-    ------
-    sl : streamline generator
-        DESCRIPTION.
+    Returns
+    -------
+    streams : streamlines.array_sequence.ArraySequence
+        Streamlines without the removed ones.
+
+    '''
+
+    keep = np.ones(len(streams), dtype=bool)
+    keep[np.ravel(idx).astype(int)] = False
+
+    return streams[keep]
+
+
+def _get_plane_bases(point_array):
+    '''
+    Computes the unit normals of the surfaces perpendicular to the mean
+    trajectory at each inner point, as well as the matrices projecting 3D
+    points onto 2D coordinates in these surfaces.
+
+    Parameters
+    ----------
+    point_array : 2D array of size (n, 3)
+        Coordinates (x,y,z) of the n mean trajectory points.
+
+    Returns
+    -------
+    normals : 2D array of size (n-2, 3)
+        Unit normals of the surfaces at the n-2 inner points.
+    proj_mats : 3D array of size (n-2, 2, 3)
+        Projection matrices onto the surfaces. The second row is the
+        projection of the z axis onto the surface, or of the y axis when the
+        normal is parallel to z.
 
     '''
 
-    for i, sl in enumerate(streams):
-        if i not in idx:
-            yield sl
+    normals = point_array[:-2]-point_array[2:]
+    normals = normals/np.linalg.norm(normals, axis=1, keepdims=True)
+
+    ref = np.zeros(normals.shape)
+    ref[:, 2] = 1
+    ref[np.abs(normals[:, 2]) > 1-1e-6] = [0, 1, 0]
+
+    y_comp = ref - np.sum(ref*normals, axis=1, keepdims=True)*normals
+    y_comp = y_comp/np.linalg.norm(y_comp, axis=1, keepdims=True)
+    x_comp = np.cross(y_comp, normals)
+
+    proj_mats = -np.stack((x_comp, y_comp), axis=1)
+
+    return normals, proj_mats
 
 
 def get_dist_from_median_trajectory(trk_file: str, point_array,
@@ -222,15 +342,59 @@ def get_dist_from_median_trajectory(trk_file: str, point_array,
     trk.to_corner()
 
     streams = trk.streamlines
-    streams_data = trk.streamlines.get_data()
+    streams_data = np.ascontiguousarray(streams.get_data(), dtype=np.float32)
+    trk_roi = tract_to_ROI(trk)
+
+    return _get_dist_from_median_trajectory(streams, streams_data, trk_roi,
+                                            point_array, compute_dist)
+
+
+def _get_dist_from_median_trajectory(streams, streams_data, trk_roi,
+                                     point_array, compute_dist: bool = True):
+    '''
+    Computes the output of get_dist_from_median_trajectory from an already
+    loaded tractogram, in voxel space with corner origin.
+
+    Parameters
+    ----------
+    streams : streamlines.array_sequence.ArraySequence
+        Streamlines of the tractogram.
+    streams_data : 2D array of size (m, 3)
+        Coordinates (x,y,z) of the m tractography points.
+    trk_roi : 3D array of size (x,y,z)
+        Binary mask of the tract, see unravel.utils.tract_to_ROI.
+    point_array : 2D array of size (n, 3)
+        Coordinates (x,y,z) of the n mean trajectory points.
+    compute_dist : bool, optional
+        Set to false to only compute median, speeds up the code.
+        The default is True.
+
+    Returns
+    -------
+    dist : 2D array of size (n, s)
+        Distance of the s streamlines to the median trajectory at each point.
+    median_array : 2D array of size (n, 3)
+        Coordinates (x,y,z) of the n median trajectory points.
+
+    '''
+
+    offsets = streams._offsets
+
+    offsets_mask = np.zeros(len(streams_data), dtype=bool)
+    offsets_mask[offsets] = True
 
     # Center of mass
-    trk_roi = tract_to_ROI(trk_file)
-    center = tuple([np.average(indices) for indices in np.where(trk_roi == 1)])
+    center = np.array([np.average(indices)
+                       for indices in np.where(trk_roi == 1)],
+                      dtype=np.float32)
 
-    dist = np.zeros((point_array.shape[0], len(streams._offsets)))
+    point_array = np.asarray(point_array, dtype=np.float32)
+    dist = np.zeros((point_array.shape[0], len(offsets)))
     median_array = point_array.copy()
 
+    # Computing normals of perpendicular surfaces at midpoints
+    normals, _ = _get_plane_bases(point_array)
+
     for i, point in enumerate(point_array):
 
         if i == 0:
@@ -238,24 +402,20 @@ def get_dist_from_median_trajectory(trk_file: str, point_array,
         if i == point_array.shape[0]-1:
             break
 
-        # Computing normal of perpendicular surface at midpoint
         midpoint = point_array[i]
-        normal = point_array[i-1]-point_array[i+1]
+        normal = normals[i-1]
 
         # Find indexes that cross the surface
-        ns = streams_data-midpoint
-        sign = np.where(np.sum(ns*normal, axis=1) > 0, 1, 0)
-        idx = np.argwhere(abs(np.roll(sign, 1)-sign) == 1)
-        idx = np.array(list(filter(lambda x: x not in streams._offsets, idx)))
+        idx = _get_crossing_indexes(streams_data@normal > midpoint@normal,
+                                    offsets_mask)
 
         # Must be same side as midpoint to center of mass
         n_mp_com = midpoint-center
-        n_xyz_com = streams_data-center
-        com_filter = np.argwhere(np.sum(n_mp_com*n_xyz_com, axis=1) < 0)
-        idx = np.array(list(filter(lambda x: x not in com_filter, idx)))
+        com_filter = streams_data@n_mp_com < n_mp_com@center
+        idx = idx[~com_filter[idx[:, 0]]]
 
         # Find position
-        idx_pos = np.take_along_axis(streams_data, idx, axis=0)
+        idx_pos = streams_data[idx[:, 0]]
         median = np.median(idx_pos, axis=0)
         median_array[i] = median
 
@@ -263,18 +423,54 @@ def get_dist_from_median_trajectory(trk_file: str, point_array,
             continue
 
         # Find distance
-        idx_dist = np.linalg.norm(idx_pos-np.repeat(median[np.newaxis, :],
-                                                    idx_pos.shape[0], axis=0),
-                                  axis=1)
-
-        for j, i_dist in enumerate(idx_dist):
+        idx_dist = np.linalg.norm(idx_pos-median, axis=1)
 
-            n = get_streamline_number_from_index(streams, idx[j])
-            dist[i, n] = i_dist
+        n = get_streamline_number_from_index(streams, idx)
+        dist[i, n] = idx_dist
 
     return dist, median_array
 
 
+def _get_gaussian_density(points, bandwidth: float,
+                          max_elements: int = 2**22):
+    '''
+    Gaussian kernel density of 2D points evaluated at the points themselves,
+    multiplied by the number of points. Same values as the exponential of
+    sklearn's KernelDensity score_samples times len(points), without building
+    a tree for the typically small point sets.
+
+    Parameters
+    ----------
+    points : 2D array of size (n, 2)
+        Coordinates of the n points.
+    bandwidth : float
+        Bandwidth of the Gaussian kernel.
+    max_elements : int, optional
+        Maximum number of elements of the pairwise distance array computed at
+        once. Rows are evaluated in chunks of max(1, max_elements//n), so the
+        memory used stays bounded whatever the number of points. The default
+        is 2**22 (32 MB of float64).
+
+    Returns
+    -------
+    dens : 1D array of size (n,)
+        Density at each point.
+
+    '''
+
+    dens = np.zeros(len(points))
+    scale = -1/(2*bandwidth**2)
+    rows = max(1, max_elements//max(len(points), 1))
+
+    for i in range(0, len(points), rows):
+        d2 = cdist(points[i:i+rows], points, 'sqeuclidean')
+        np.multiply(d2, scale, out=d2)
+        np.exp(d2, out=d2)
+        dens[i:i+rows] = d2.sum(axis=1)
+
+    return dens/(2*np.pi*bandwidth**2)
+
+
 def remove_outlier_streamlines(trk_file, point_array, out_file: str = None,
                                outlier_ratio: float = 0,
                                remove_outlier_dir: bool = False,
@@ -330,11 +526,21 @@ def remove_outlier_streamlines(trk_file, point_array, out_file: str = None,
     trk.to_corner()
 
     streams = trk.streamlines
+    streams_data = np.ascontiguousarray(streams.get_data(), dtype=np.float32)
+    offsets = streams._offsets
+    lengths = streams._lengths
 
     bandwidth = bandwidth*neighbors_required
 
-    streams_data = trk.streamlines.get_data()
-    dens = np.zeros((point_array.shape[0], len(streams._offsets)))
+    point_array = np.asarray(point_array, dtype=np.float32)
+    dens = np.zeros((point_array.shape[0], len(offsets)))
+
+    offsets_mask = np.zeros(len(streams_data), dtype=bool)
+    offsets_mask[offsets] = True
+
+    # Computing normals of perpendicular surfaces at midpoints and the
+    # projection matrices onto these surfaces
+    normals, proj_mats = _get_plane_bases(point_array)
 
     for i, point in enumerate(point_array):
 
@@ -343,37 +549,23 @@ def remove_outlier_streamlines(trk_file, point_array, out_file: str = None,
         if i == point_array.shape[0]-1:
             break
 
-        # Computing normal of perpendicular surface at midpoint
         midpoint = point_array[i]
-        normal = point_array[i-1]-point_array[i+1]
-        normal = normal/np.linalg.norm(normal)
+        normal = normals[i-1]
 
         # Find indexes that cross the surface
-        ns = streams_data-midpoint
-        dot = np.sum(ns*normal, axis=1)
-        sign = np.where(dot > 0, 1, 0)
-        idx = np.argwhere(abs(np.roll(sign, 1)-sign) == 1)
-        idx = np.array(list(filter(lambda x: x not in streams._offsets, idx)))
+        dot = streams_data@normal-midpoint@normal
+        idx = _get_crossing_indexes(dot > 0, offsets_mask)
 
         # Find position
-        idx_pos = np.take_along_axis(streams_data, idx, axis=0)
+        idx_pos = streams_data[idx[:, 0]]
 
         # Project onto plane
         ns_pos = idx_pos-midpoint
         dot_pos = dot[idx[:, 0]]
         proj_onto_plane = (ns_pos - dot_pos[..., np.newaxis]*normal) + midpoint
+        points_2D = proj_onto_plane @ proj_mats[i-1].T
 
-        z_vec = np.array([0, 0, 1])
-        y_comp = z_vec - (z_vec@normal)*normal
-        y_comp = y_comp/np.linalg.norm(y_comp)
-        x_comp = np.cross(y_comp, normal)
-
-        proj_mat = -np.vstack([x_comp, y_comp])  # build projection matrix
-        points_2D = proj_onto_plane @ proj_mat.T       # apply projection
-
-        kde_model = KernelDensity(
-            kernel='gaussian', bandwidth=bandwidth).fit(points_2D)
-        kde = np.exp(kde_model.score_samples(points_2D))*len(points_2D)
+        kde = _get_gaussian_density(points_2D, bandwidth)
 
         n = get_streamline_number_from_index(streams, idx)
 
@@ -405,25 +597,8 @@ def remove_outlier_streamlines(trk_file, point_array, out_file: str = None,
 
     if remove_outlier_dir:
 
-        streams_data = trk.streamlines.get_data()
-
-        # Clustering end nodes based on streamline directions
-        end_0 = streams_data[streams._offsets, :]
-        end_1 = np.roll(streams_data[streams._offsets-1, :], -1, axis=0)
-        dirs = end_1-end_0
-        kmeans = KMeans(n_clusters=2, n_init="auto").fit(dirs)
-
-        # Assigning start and end based on clustering
-        start = end_0.copy()
-        end = end_1.copy()
-        start[kmeans.labels_ == 1, :] = end_1[kmeans.labels_ == 1, :]
-        end[kmeans.labels_ == 1, :] = end_0[kmeans.labels_ == 1, :]
-
-        # Only compute the mean end points of long fibers [Q3:Q3+1.5*IQR]
-        q1, q3 = np.percentile(streams._lengths, [25, 75])
-        long_streamlines = streams._lengths > q3
-        outlier_streamlines = streams._lengths > q3+1.5*(q3-q1)
-        selec_streamlines = long_streamlines*~outlier_streamlines
+        start, end, selec_streamlines = _orient_endpoints(streams_data,
+                                                          offsets, lengths)
         m_start = np.mean(start[selec_streamlines], axis=0)
         m_end = np.mean(end[selec_streamlines], axis=0)
 
@@ -439,8 +614,7 @@ def remove_outlier_streamlines(trk_file, point_array, out_file: str = None,
         bw = bandwidth_dir
         nb = neighbors_required_dir
         bw = bw*nb
-        kde_model = KernelDensity(kernel='gaussian', bandwidth=bw).fit(X)
-        dens = np.exp(kde_model.score_samples(X))*len(X)
+        dens = _get_gaussian_density(X, bw)
 
         thresh = nb/(2*np.pi*bw**2)
 
@@ -491,69 +665,52 @@ def get_roi_sections_from_nodes(trk_file: str, point_array,
     # Center of mass
     center = tuple([np.average(indices) for indices in np.where(trk_roi == 1)])
 
-    # Meshgrid of coordinates
-    x_val = np.linspace(0.5, trk_roi.shape[0]-0.5, trk_roi.shape[0])
-    y_val = np.linspace(0.5, trk_roi.shape[1]-0.5, trk_roi.shape[1])
-    z_val = np.linspace(0.5, trk_roi.shape[2]-0.5, trk_roi.shape[2])
-    xyz = np.stack(np.meshgrid(x_val, y_val, z_val, indexing='ij'), axis=3)
-    xyz_flat = xyz.reshape(xyz.shape[0]*xyz.shape[1]*xyz.shape[2], 3)
+    # Only the voxels of the tract are tested against the planes
+    voxels = np.argwhere(trk_roi == 1)
+    voxels_xyz = voxels+0.5
+
+    # Duplicating end points so that previous and next points always exist
+    padded = np.vstack((point_array[:1], point_array, point_array[-1:]))
 
     for i, _ in enumerate(point_array):
 
         if i == 0:
             continue
 
-        try:
-            m_previous = point_array[i-2]
-        except IndexError:
-            m_previous = point_array[i-1]
-        m_start = point_array[i-1]
-        m_end = point_array[i]
-        try:
-            m_next = point_array[i+1]
-        except IndexError:
-            m_next = point_array[i]
+        m_previous = padded[i-1]
+        m_start = padded[i]
+        m_end = padded[i+1]
+        m_next = padded[i+2]
         midpoint = (m_start+m_end)/2
 
         # Computing normals
         n_start = m_previous-m_end
         n_end = m_start-m_next
-        n_mp_start = m_start-midpoint
-        n_mp_end = midpoint-m_end
-        n_xyz_start = m_start-xyz_flat
-        n_xyz_end = xyz_flat-m_end
 
-        # Find indexes that are between current plane and previous plane
-        sign_xyz_start = np.where(
-            np.sum(n_start*n_xyz_start, axis=1) > 0, 1, -1)
-        sign_xyz_end = np.where(np.sum(n_end*n_xyz_end, axis=1) > 0, 1, -1)
-
-        # Must be same side as midpoint
-        sign_mp_start = np.where(np.sum(n_start*n_mp_start) > 0, 1, -1)
-        sign_mp_end = np.where(np.sum(n_end*n_mp_end) > 0, 1, -1)
-
-        sign_mp_slice = (np.where(sign_xyz_start == sign_mp_start, 1, 0)
-                         + np.where(sign_xyz_end == sign_mp_end, 1, 0))
-        sign_mp_slice = np.where(sign_mp_slice == 2, 1, 0)
+        # Find indexes that are between current plane and previous plane,
+        # must be same side as midpoint
+        sign_mp_start = n_start@(m_start-midpoint) > 0
+        sign_mp_end = n_end@(midpoint-m_end) > 0
+        sign_xyz_start = (voxels_xyz-m_start)@n_start < 0
+        sign_xyz_end = (voxels_xyz-m_end)@n_end > 0
+        in_slice = ((sign_xyz_start == sign_mp_start)
+                    & (sign_xyz_end == sign_mp_end))
 
         # Must be same side as midpoint to center of mass
         n_mp_com = midpoint-center
-        n_xyz_com = xyz_flat-center
-        sign_mp_com = np.where(np.sum(n_mp_com*n_xyz_com, axis=1) > 0, 1, 0)
-
-        roi_mp_slice = sign_mp_slice.reshape(trk_roi.shape)*trk_roi
-        roi_mp_com = sign_mp_com.reshape(trk_roi.shape)*trk_roi
-        roi = roi_mp_slice + roi_mp_com
+        roi = in_slice & ((voxels_xyz-center)@n_mp_com > 0)
 
         # Adding only regions selected by filters but connected to midpoint
         if simplify_shape:
             dot = tuple(np.floor(midpoint).astype(int))
-            if roi[dot] == 2:
-                roi_connec = flood(roi*roi_mp_slice, dot, tolerance=1,
-                                   connectivity=1)
-                roi = np.where(roi_connec == 1, 2, 0)
+            roi_mp_slice = np.zeros(trk_roi.shape, dtype=bool)
+            roi_mp_slice[tuple(voxels[in_slice].T)] = True
+            if (roi_mp_slice[dot]
+                    and (np.array(dot)+0.5-center)@n_mp_com > 0):
+                mask[flood(roi_mp_slice, dot, connectivity=1)] = i
+                continue
 
-        mask[roi == 2] = i
+        mask[tuple(voxels[roi].T)] = i
 
     return mask.astype(int)
 
@@ -583,16 +740,14 @@ def smooth_streamlines(trk_file: str, out_file: str = None):
     streams = trk.streamlines
     point = streams.get_data()
 
-    smoothed_point = (np.roll(point, 1, axis=0) + point +
-                      np.roll(point, -1, axis=0))/3
-
-    streams._data = smoothed_point
+    smoothed_point = np.empty_like(point)
+    smoothed_point[1:-1] = (point[:-2] + point[1:-1] + point[2:])/3
 
     # Setting end points back to original values
-    starts = streams._offsets
-    ends = starts-1
-    streams._data[starts] = point[starts]
-    streams._data[ends] = point[ends]
+    ends = np.concatenate((streams._offsets, streams._offsets-1))
+    smoothed_point[ends] = point[ends]
+
+    streams._data = smoothed_point
 
     if out_file is None:
         out_file = trk_file
@@ -6,6 +6,7 @@ Created on Sat Jun  4 22:17:13 2022
 """
 
 import numpy as np
+from dipy.io.stateful_tractogram import StatefulTractogram
 from dipy.io.streamline import load_tractogram, save_tractogram
 
 
@@ -16,8 +17,10 @@ def tract_to_ROI(trk_file: str):
 
     Parameters
     ----------
-    trk_file : str
-        Path to tractography file (.trk)
+    trk_file : str or tractogram
+        Path to tractography file (.trk) or already loaded tractogram. A
+        loaded tractogram is converted in place to voxel space with corner
+        origin (to_vox() and to_corner()).
 
     Returns
     -------
@@ -26,7 +29,10 @@ def tract_to_ROI(trk_file: str):
 
     '''
 
-    trk = load_tractogram(trk_file, 'same')
+    if isinstance(trk_file, StatefulTractogram):
+        trk = trk_file
+    else:
+        trk = load_tractogram(trk_file, 'same')
     trk.to_vox()
     trk.to_corner()
 